@@ -103,6 +103,7 @@ class PixelCalculator:
     def unload(self):
         """Removes the plugin menu item and icon from QGIS GUI."""
         for action in self.actions:
+            action.deactivate()
             self.iface.removePluginRasterMenu(
                 self.tr(u'Pixel&Calculator'),
                 action)
@@ -1,9 +1,12 @@
+import PyQt5.QtCore as QtCore
 import PyQt5.QtGui as QtGui
 import PyQt5.QtWidgets as QtWidgets
 import qgis.core as QGisCore
 
 from .layer import PixelisedVectorLayer
 
+_RASTER_LAYER_CLASS = QGisCore.QgsRasterLayer
+
 
 class PixelMeasureAction(QtWidgets.QAction):
     """Class representing the action to start the pixel measure.
@@ -28,9 +31,13 @@ class PixelMeasureAction(QtWidgets.QAction):
                                    parent)
 
         self.mapCanvas = self.main.iface.mapCanvas()
-        self.mapCanvas.extentsChanged.connect(self._populateVisible)
+        self.project = QGisCore.QgsProject.instance()
 
-        self.main.iface.currentLayerChanged.connect(self._populateApplicable)
+        # Coalesce the bursts of extentsChanged signals while panning and zooming into a single update.
+        self._visibilityTimer = QtCore.QTimer(self)
+        self._visibilityTimer.setSingleShot(True)
+        self._visibilityTimer.setInterval(50)
+        self._visibilityTimer.timeout.connect(self._populateVisible)
 
         self.previousMapTool = None
         self.rasterLayer = None
@@ -38,39 +45,155 @@ class PixelMeasureAction(QtWidgets.QAction):
         self.layer = None
         self.activeLayer = None
 
+        self._visibleToolTip = None
+        self._invisibleToolTip = None
+        self._lastVisibilityState = None
+        self._lastActiveLayerId = None
+
+        # Calculation layers of previous measurements, by id of their raster layer.
+        self._layerCache = {}
+
+        self._connected = False
+        self._connectSignals()
+
         self._populateApplicable()
 
         self.setCheckable(True)
+
+    def _connectSignals(self):
+        """Connect the signals of the map canvas, the interface and the action itself.
+        Does nothing if they are connected already.
+        """
+        if self._connected:
+            return
+
+        self.mapCanvas.extentsChanged.connect(self._visibilityTimer.start)
+        self.main.iface.currentLayerChanged.connect(self._populateApplicable)
         self.triggered.connect(self.activate)
+        self.project.cleared.connect(self._cb_projectCleared)
+        self.project.layersRemoved.connect(self._cb_layersRemoved)
+        self._connected = True
+
+    def _disconnectSignals(self):
+        """Disconnect the signals connected in _connectSignals().
+        Does nothing if they are not connected.
+        """
+        if not self._connected:
+            return
+
+        for signal, slot in ((self.mapCanvas.extentsChanged, self._visibilityTimer.start),
+                             (self.main.iface.currentLayerChanged, self._populateApplicable),
+                             (self.triggered, self.activate),
+                             (self.project.cleared, self._cb_projectCleared),
+                             (self.project.layersRemoved, self._cb_layersRemoved)):
+            try:
+                signal.disconnect(slot)
+            except TypeError:
+                # Not connected (anymore).
+                pass
+        self._visibilityTimer.stop()
+        self._setRasterLayer(None)
+        self._lastActiveLayerId = None
+        self._connected = False
 
     def _populateApplicable(self):
-        """Save the active layer, set the raster layer if applicable and call _populateVisible()."""
-        self.active_layer = self.main.iface.activeLayer()
-        if isinstance(self.active_layer, QGisCore.QgsRasterLayer):
-            self.rasterLayer = self.active_layer
+        """Save the active layer, set the raster layer if applicable and call _populateVisible().
+        Does nothing if the active layer did not change since the previous call, or if the action
+        has been deactivated."""
+        if not self._connected:
+            return
+
+        activeLayer = self.main.iface.activeLayer()
+        activeLayerId = activeLayer.id() if activeLayer is not None else None
+        if activeLayerId is not None and activeLayerId == self._lastActiveLayerId:
+            return
+        self._lastActiveLayerId = activeLayerId
+
+        self.active_layer = activeLayer
+        # Most raster layers are exactly QgsRasterLayer, check that first before walking the class hierarchy.
+        if type(self.active_layer) is _RASTER_LAYER_CLASS or isinstance(self.active_layer, _RASTER_LAYER_CLASS):
+            self._setRasterLayer(self.active_layer)
+        else:
+            self._setRasterLayer(None)
+        self._populateVisible()
+
+    def _setRasterLayer(self, rasterLayer):
+        """Set the raster layer to measure on and build its tooltips.
+        Follow the changes of the name and the configuration (e.g. the scale based
+        visibility) of the raster layer, to keep the tooltips and the state of the
+        action up to date.
+
+        Parameters
+        ----------
+        rasterLayer : QGisCore.QgsRasterLayer or None
+            The raster layer, or `None` if no raster layer is selected.
+        """
+        if self.rasterLayer is not None and self.rasterLayer is not rasterLayer:
+            try:
+                self.rasterLayer.nameChanged.disconnect(self._cb_rasterLayerNameChanged)
+                self.rasterLayer.configChanged.disconnect(self._cb_rasterLayerConfigChanged)
+                self.rasterLayer.repaintRequested.disconnect(self._cb_rasterLayerConfigChanged)
+            except (TypeError, RuntimeError):
+                # Not connected anymore or the raster layer has been deleted already.
+                pass
+
+        if rasterLayer is not None and rasterLayer is not self.rasterLayer:
+            rasterLayer.nameChanged.connect(self._cb_rasterLayerNameChanged)
+            # Changing the scale range of the layer does not change the extent of the map canvas.
+            rasterLayer.configChanged.connect(self._cb_rasterLayerConfigChanged)
+            rasterLayer.repaintRequested.connect(self._cb_rasterLayerConfigChanged)
+
+        self.rasterLayer = rasterLayer
+        self._setToolTips()
+
+    def _setToolTips(self):
+        """Build the tooltips of the action for the current raster layer."""
+        if self.rasterLayer is not None:
+            self._visibleToolTip = self.main.tr("Calculate pixelvalue for layer") + f" '{self.rasterLayer.name()}'."
+            self._invisibleToolTip = self.main.tr(
+                "The selected layer '{}' is not visible at this scale.").format(self.rasterLayer.name())
         else:
-            self.rasterLayer = None
+            self._visibleToolTip = self._invisibleToolTip = None
+
+    def _cb_rasterLayerConfigChanged(self):
+        """Schedule an update of the state of the action, the scale range of the raster layer might have
+        changed."""
+        self._visibilityTimer.start()
+
+    def _cb_rasterLayerNameChanged(self):
+        """Rebuild the tooltips with the new name of the raster layer and show them."""
+        self._setToolTips()
+        self._lastVisibilityState = None
         self._populateVisible()
 
     def _populateVisible(self):
         """Enable or disable the action based on the visibility of the raster layer.
         Only show the action in the toolbar if the corresponding raster layer
         is visible too.
+        Nothing is updated if the scale, raster layer (and its scale range) and
+        calculation layer did not change since the previous call.
         """
+        scale = self.mapCanvas.scale()
+        scaleRange = None
+        if self.rasterLayer is not None:
+            scaleRange = (self.rasterLayer.hasScaleBasedVisibility(),
+                          self.rasterLayer.minimumScale(), self.rasterLayer.maximumScale())
+
+        if self._lastVisibilityState is not None:
+            lastScale, lastRasterLayer, lastScaleRange, lastLayer = self._lastVisibilityState
+            if scale == lastScale and self.rasterLayer is lastRasterLayer and scaleRange == lastScaleRange and \
+                    self.layer is lastLayer:
+                return
+        self._lastVisibilityState = (scale, self.rasterLayer, scaleRange, self.layer)
+
         if self.layer is not None:
             self.setToolTip(self.main.tr('Calculation active. End the current calculation.'))
             self.setEnabled(True)
-        elif self.rasterLayer and \
-            ((self.rasterLayer.hasScaleBasedVisibility() and
-             self.rasterLayer.isInScaleRange(self.mapCanvas.scale())) or
-                not self.rasterLayer.hasScaleBasedVisibility()):
-            self.setToolTip(self.main.tr("Calculate pixelvalue for layer") + f" '{self.rasterLayer.name()}'.")
+        elif self.rasterLayer is not None and self.rasterLayer.isInScaleRange(scale):
+            self.setToolTip(self._visibleToolTip)
             self.setEnabled(True)
-        elif self.rasterLayer and \
-                (self.rasterLayer.hasScaleBasedVisibility()
-                 and not self.rasterLayer.isInScaleRange(self.mapCanvas.scale())):
-            self.setToolTip(self.main.tr(
-                "The selected layer '{}' is not visible at this scale.").format(self.rasterLayer.name()))
+        elif self.rasterLayer is not None:
+            self.setToolTip(self._invisibleToolTip)
             self.setEnabled(False)
         else:
             self.setToolTip(self.main.tr('Select a raster layer to start a calculation.'))
@@ -91,40 +214,84 @@ class PixelMeasureAction(QtWidgets.QAction):
 
     def startMeasure(self):
         """Start measuring.
-        Add a PixelisedVectorLayer to the project and start drawing.
+        Add a PixelisedVectorLayer to the project and start drawing. Reuse the
+        layer of a previous measurement on the same raster layer if available.
         """
-        layer = PixelisedVectorLayer(self, rasterLayer=self.rasterLayer,
-                                     path='Multipolygon?crs=epsg:31370',
-                                     baseName=self.main.tr('Pixel calculation'),
-                                     providerLib='memory')
+        layer = self._layerCache.pop(self.rasterLayer.id(), None)
+        # Layer ids are saved in the project, after reopening it the same id belongs to a new raster layer.
+        if layer is not None and layer.rasterLayer is self.rasterLayer:
+            layer.reset()
+        else:
+            layer = PixelisedVectorLayer(self, rasterLayer=self.rasterLayer,
+                                         path='Multipolygon?crs=epsg:31370',
+                                         baseName=self.main.tr('Pixel calculation'),
+                                         providerLib='memory')
         self.calculatedLayer = self.rasterLayer
-        self.layer = QGisCore.QgsProject.instance().addMapLayer(layer, False)
-        QGisCore.QgsProject.instance().layerTreeRoot().insertLayer(0, layer)
+        self.layer = self.project.addMapLayer(layer, False)
+        self.project.layerTreeRoot().insertLayer(0, layer)
         self.main.iface.setActiveLayer(self.layer)
         self.main.iface.actionToggleEditing().trigger()
         self.main.iface.actionAddFeature().trigger()
 
     def stopMeasure(self):
         """Stop measuring.
-        Remove memory layer from project.
+        Remove memory layer from project and keep it for a next measurement on
+        the same raster layer.
         """
         self.setChecked(False)
         if self.layer:
             try:
-                QGisCore.QgsProject.instance().removeMapLayer(
-                    self.layer.id())
+                # Rolling back does not emit beforeCommitChanges, stop the running task ourselves.
+                self.layer.cancelTask()
+                if self.layer.isEditable():
+                    self.layer.rollBack()
+                layer = self.project.takeMapLayer(self.layer)
                 self.main.iface.mapCanvas().refresh()
+                if layer is not None:
+                    # Do not keep the raster block in memory while the layer is not in use.
+                    layer.clearBlockCache()
+                    self._cacheLayer(self.calculatedLayer.id(), layer)
             except RuntimeError:
+                # The layer (or its raster layer) has been removed from the project by the user.
                 pass
             self.layer = None
 
             self.main.iface.setActiveLayer(self.calculatedLayer)
-            self.rasterLayer = None
+            self._setRasterLayer(None)
             self.calculatedLayer = None
+            self._lastActiveLayerId = None
             self._populateApplicable()
 
+    def _cacheLayer(self, rasterLayerId, layer):
+        """Keep the calculation layer of a raster layer for reuse by a next measurement.
+
+        Parameters
+        ----------
+        rasterLayerId : str
+            Id of the raster layer of the calculation layer.
+        layer : PixelisedVectorLayer
+            Calculation layer, removed from the project.
+        """
+        self._layerCache[rasterLayerId] = layer
+
+    def _cb_projectCleared(self):
+        """Drop all cached calculation layers, their raster layers are gone with the project."""
+        self._layerCache.clear()
+
+    def _cb_layersRemoved(self, layerIds):
+        """Drop the cached calculation layers of the raster layers removed from the project.
+
+        Parameters
+        ----------
+        layerIds : list of str
+            Ids of the removed layers.
+        """
+        for layerId in layerIds:
+            self._layerCache.pop(layerId, None)
+
     def deactivate(self):
-        """Deactivate by disconnecting signals and stopping measurement."""
-        self.triggered.disconnect(self.startMeasure)
-        self.mapCanvas.extentsChanged.connect(self._populateVisible)
+        """Deactivate by stopping measurement and disconnecting signals."""
+        # Stopping the measurement selects the raster layer again, disconnect afterwards.
         self.stopMeasure()
+        self._disconnectSignals()
+        self._layerCache.clear()
@@ -1,8 +1,53 @@
+import functools
+
+import PyQt5.QtCore as QtCore
 import PyQt5.QtGui as QtGui
 import qgis.core as QGisCore
 
 from .wrapper import RasterBlockWrapperTask
 
+# Fill symbol properties of the pixelised polygons, overriding the defaults.
+_SYMBOL_PROPS = {
+    'color': '255,255,255,64',
+    'outline_color': '0,0,0,255',
+    'outline_width': '1',
+}
+
+
+@functools.lru_cache(maxsize=1)
+def _label_settings():
+    """Build the label settings of the layer, these are the same for all PixelisedVectorLayers.
+    The labeling of a layer takes a copy of the settings, so they can be shared.
+
+    Returns
+    -------
+    QGisCore.QgsPalLayerSettings
+        Label settings of the layer.
+    """
+    label_settings = QGisCore.QgsPalLayerSettings()
+    label_settings.enabled = True
+    # Round in an expression rather than formatting the number, which would use the decimal separator of the locale.
+    label_settings.fieldName = 'round("mean", 2)'
+    label_settings.isExpression = True
+    label_settings.placement = QGisCore.QgsPalLayerSettings.AroundPoint
+
+    label_format = QGisCore.QgsTextFormat()
+    label_format.setSize(12)
+    label_format.setNamedStyle('Bold')
+    label_format.setColor(QtGui.QColor(0, 0, 0, 255))
+
+    label_buffer = QGisCore.QgsTextBufferSettings()
+    label_buffer.setEnabled(True)
+    label_buffer.setSize(1.5)
+    label_buffer.setColor(QtGui.QColor(255, 255, 255, 255))
+    label_format.setBuffer(
+        label_buffer
+    )
+    label_settings.setFormat(
+        label_format
+    )
+    return label_settings
+
 
 class PixelisedVectorLayer(QGisCore.QgsVectorLayer):
     """Class representing a pixelised polygon layer.
@@ -35,13 +80,46 @@ class PixelisedVectorLayer(QGisCore.QgsVectorLayer):
                                              loadDefaultStyleFlag, readExtentFromXml=False))
         self.rasterLayer = rasterLayer
         self.action = action
+        self._blockCache = None
+        self.task = None
+        self._taskSlots = None
+        self.taskManager = QGisCore.QgsApplication.taskManager()
 
+        self._set_fields()
         self._set_scaleBasedVisibility()
         self._set_labeling()
 
         self.editingStarted.connect(self._cb_editingStarted)
         self.beforeCommitChanges.connect(self._cb_beforeCommitChanges)
 
+        # The cached raster block is stale as soon as the data of the raster layer changes.
+        self.rasterLayer.dataChanged.connect(self.clearBlockCache)
+        self.rasterLayer.dataSourceChanged.connect(self.clearBlockCache)
+
+    def reset(self):
+        """Prepare the layer for reuse in a new measurement.
+        Stop the task of the previous measurement, drop the cached raster block, remove all
+        features and update the scaleBasedVisibility to that of the raster layer.
+        """
+        self.cancelTask()
+        self.clearBlockCache()
+        self.dataProvider().truncate()
+        self._set_scaleBasedVisibility()
+
+    def clearBlockCache(self):
+        """Drop the raster block cached by the previous tasks, the next task reads it again."""
+        self._blockCache = None
+
+    def _set_fields(self):
+        """Add the field holding the mean value of the cells of each feature, used as its label.
+        Suppress the attribute form when drawing, the field is filled in by the calculation."""
+        self.dataProvider().addAttributes([QGisCore.QgsField('mean', QtCore.QVariant.Double)])
+        self.updateFields()
+
+        form_config = self.editFormConfig()
+        form_config.setSuppress(QGisCore.QgsEditFormConfig.SuppressOn)
+        self.setEditFormConfig(form_config)
+
     def _set_scaleBasedVisibility(self):
         """Set the scaleBasedVisibility based on that of the raster layer we're drawing upon."""
         if self.rasterLayer.hasScaleBasedVisibility():
@@ -54,33 +132,11 @@ class PixelisedVectorLayer(QGisCore.QgsVectorLayer):
     def _set_labeling(self):
         """Set the label formatting of the layer."""
         props = self.renderer().symbol().symbolLayer(0).properties()
-        props['color'] = '255,255,255,64'
-        props['outline_color'] = '0,0,0,255'
-        props['outline_width'] = '1'
+        props.update(_SYMBOL_PROPS)
         self.renderer().setSymbol(
             QGisCore.QgsFillSymbol.createSimple(props))
 
-        label_settings = QGisCore.QgsPalLayerSettings()
-        label_settings.enabled = True
-        label_settings.placement = QGisCore.QgsPalLayerSettings.AroundPoint
-
-        label_format = QGisCore.QgsTextFormat()
-        label_format.setSize(12)
-        label_format.setNamedStyle('Bold')
-        label_format.setColor(QtGui.QColor(0, 0, 0, 255))
-
-        label_buffer = QGisCore.QgsTextBufferSettings()
-        label_buffer.setEnabled(True)
-        label_buffer.setSize(1.5)
-        label_buffer.setColor(QtGui.QColor(255, 255, 255, 255))
-        label_format.setBuffer(
-            label_buffer
-        )
-        label_settings.setFormat(
-            label_format
-        )
-
-        self.setLabeling(QGisCore.QgsVectorLayerSimpleLabeling(label_settings))
+        self.setLabeling(QGisCore.QgsVectorLayerSimpleLabeling(_label_settings()))
         self.setLabelsEnabled(True)
 
     def _cb_editingStarted(self):
@@ -89,9 +145,72 @@ class PixelisedVectorLayer(QGisCore.QgsVectorLayer):
         self.editBuffer().featureAdded.connect(self._cb_featureAdded)
 
     def _cb_beforeCommitChanges(self):
-        """Disconnect the featureAdded signal.
+        """Disconnect the featureAdded signal and the signals of the task.
         """
         self.editBuffer().featureAdded.disconnect(self._cb_featureAdded)
+        self._disconnectTask()
+
+    def _disconnectTask(self):
+        """Disconnect the signals of the current RasterBlockWrapper task, if any.
+        """
+        if self._taskSlots is None:
+            return
+
+        completedSlot, failedSlot = self._taskSlots
+        self._taskSlots = None
+        try:
+            self.task.completed.disconnect(completedSlot)
+            self.task.failed.disconnect(failedSlot)
+        except (TypeError, RuntimeError):
+            # Not connected anymore or the task has been deleted by the task manager already.
+            pass
+
+    def cancelTask(self):
+        """Disconnect the signals of the current RasterBlockWrapper task, if any, and cancel it.
+        A task that is still running will not change the features of the layer anymore.
+        """
+        self._disconnectTask()
+
+        if self.task is not None:
+            try:
+                self.task.cancel()
+            except RuntimeError:
+                # The task has been deleted by the task manager already.
+                pass
+            self.task = None
+
+    def _drawPixelisedFeature(self, fid, result):
+        """Draw the result from the RasterBlockWrapper task in the layer.
+
+        Parameters
+        ----------
+        fid : int
+            Feature id of the added feature.
+        result : tuple
+            Tuple of the new geometry and a dictionary of its statistics.
+        """
+        geometry, stats = result
+        if geometry is not None:
+            self.changeGeometry(fid, geometry)
+            self.changeAttributeValue(fid, self.fields().indexOf('mean'), stats['mean'])
+            self.triggerRepaint()
+        else:
+            self.editBuffer().deleteFeature(fid)
+
+        self.commitChanges()
+
+    def _handleFailed(self, fid):
+        """Handle the case where we got no result from the task, either because there is no overlap
+        with the raster or because the task was canceled.
+
+        Parameters
+        ----------
+        fid : int
+            Feature id of the added feature.
+        """
+        self.editBuffer().deleteFeature(fid)
+        self.commitChanges()
+        self.action.stopMeasure()
 
     def _cb_featureAdded(self, fid):
         """Pixelise the feature drawn.
@@ -104,36 +223,17 @@ class PixelisedVectorLayer(QGisCore.QgsVectorLayer):
         fid : int
             Feature id of the added feature.
         """
-        def drawPixelisedFeature(result):
-            """Draw the result from the RasterBlockWrapper task in the layer."""
-            geometry, stats = result
-            if geometry is not None:
-                self.changeGeometry(fid, geometry)
-
-                label_settings = self.labeling().settings()
-                label_settings.fieldName = "%0.2f" % stats['mean']
-                label_settings.isExpression = True
-
-                self.labeling().setSettings(label_settings)
-                self.triggerRepaint()
-            else:
-                self.editBuffer().deleteFeature(fid)
-
-            self.commitChanges()
-
-        def handleFailed():
-            """Handle the case where we got no result from the task, either because there is no overlap
-            with the raster or because the task was canceled."""
-            self.editBuffer().deleteFeature(fid)
-            self.commitChanges()
-            self.action.stopMeasure()
-
         self.action.iface.actionPan().trigger()
         ft = next(self.getFeatures(QGisCore.QgsFeatureRequest(fid)))
 
-        self.task = RasterBlockWrapperTask(self.action.main, self.rasterLayer, 1, ft.geometry())
+        self.task = RasterBlockWrapperTask(self.action.main, self.rasterLayer, 1, ft.geometry(),
+                                           blockCache=self._blockCache)
+        self._blockCache = self.task.blockCache
 
-        self.task.completed.connect(drawPixelisedFeature)
-        self.task.failed.connect(handleFailed)
+        # Keep the slots, so they can be disconnected again before committing.
+        self._taskSlots = (functools.partial(self._drawPixelisedFeature, fid),
+                           functools.partial(self._handleFailed, fid))
+        self.task.completed.connect(self._taskSlots[0])
+        self.task.failed.connect(self._taskSlots[1])
 
-        QGisCore.QgsApplication.taskManager().addTask(self.task)
+        self.taskManager.addTask(self.task)
@@ -1,8 +1,26 @@
-from multiprocessing import Lock
+import math
+
+import numpy as np
+from osgeo import gdal, ogr
 import PyQt5.QtCore as QtCore
 import qgis.core as QGisCore
 
-from .pool import WorkerThreadPool
+# NumPy equivalents of the QGIS raster data types we can read directly from the block buffer.
+_NUMPY_DTYPES = {
+    QGisCore.Qgis.Byte: np.uint8,
+    QGisCore.Qgis.UInt16: np.uint16,
+    QGisCore.Qgis.Int16: np.int16,
+    QGisCore.Qgis.UInt32: np.uint32,
+    QGisCore.Qgis.Int32: np.int32,
+    QGisCore.Qgis.Float32: np.float32,
+    QGisCore.Qgis.Float64: np.float64,
+}
+
+# Maximum number of cells of the raster block to read at once, larger blocks are read in tiles.
+_MAX_BLOCK_CELLS = 1024 * 1024
+
+# Minimum number of parts of a multipart geometry before we index its parts spatially.
+_PART_INDEX_THRESHOLD = 8
 
 
 class RasterBlockWrapperTask(QGisCore.QgsTask):
@@ -11,7 +29,7 @@ class RasterBlockWrapperTask(QGisCore.QgsTask):
     completed = QtCore.pyqtSignal(object)
     failed = QtCore.pyqtSignal()
 
-    def __init__(self, main, rasterLayer, band, geometry):
+    def __init__(self, main, rasterLayer, band, geometry, blockCache=None):
         """Initialisation.
         Aligns the given geometry to the grid of the raster layer.
 
@@ -26,6 +44,10 @@ class RasterBlockWrapperTask(QGisCore.QgsTask):
             for the new geometry.
         geometry : QGisCore.QgsGeometry
             Geometry to align to the raster grid.
+        blockCache : tuple, optional
+            The `blockCache` of a previous task on the same raster layer. Its
+            raster block is reused when it covers the block needed for this
+            geometry.
         """
         super().__init__(main.tr('Calculating pixelvalue'), QGisCore.QgsTask.CanCancel)
         self.setDependentLayers([rasterLayer])
@@ -33,31 +55,76 @@ class RasterBlockWrapperTask(QGisCore.QgsTask):
 
         self.rasterLayer = rasterLayer
         self.band = band
-        self.geometry = geometry
 
-        self.geomBbox = self.geometry.boundingBox()
+        # Read the nodata value here, in the main thread: the data provider is not thread safe.
+        provider = self.rasterLayer.dataProvider()
+        self.noData = provider.sourceNoDataValue(band) if provider.sourceHasNoDataValue(band) else None
+        self._engine = None
 
         self.pixelSizeX = self.rasterLayer.rasterUnitsPerPixelX()
         self.pixelSizeY = self.rasterLayer.rasterUnitsPerPixelY()
         self.pixelArea = self.pixelSizeX*self.pixelSizeY
+        # Minimum overlap with the geometry for a raster cell to belong to it: 50%.
+        self.minOverlapArea = self.pixelArea*0.5
 
         self._buffer = max(self.pixelSizeX, self.pixelSizeY)
+
+        self.geometry = self._clipGeometry(geometry)
+        self._indexParts()
+
+        self.geomBbox = self.geometry.boundingBox()
         self.geomBbox = self.geomBbox.buffered(self._buffer)
 
-        if self.geomBbox.intersects(self.rasterLayer.extent()):
+        if not self.geometry.isEmpty() and self.geomBbox.intersects(self.rasterLayer.extent()):
             self.blockBbox = self._alignRectangleToGrid(self.geomBbox)
-            self.blockWidth = int(self.blockBbox.width()/self.pixelSizeX)
-            self.blockHeight = int(self.blockBbox.height()/self.pixelSizeY)
-            self.block = self.rasterLayer.dataProvider().block(self.band,
-                                                               self.blockBbox,
-                                                               self.blockWidth,
-                                                               self.blockHeight)
+            self.blockWidth = int(round(self.blockBbox.width()/self.pixelSizeX))
+            self.blockHeight = int(round(self.blockBbox.height()/self.pixelSizeY))
+            self._readBlock(blockCache)
         else:
             self.blockBbox = self.blockWidth = self.blockHeight = self.block = None
+            self.blockArray = None
+            self.blockCache = blockCache
 
         self.stats = {}
         self.newGeometry = None
 
+    def _clipGeometry(self, geometry):
+        """Clip the given geometry to the extent of the raster layer.
+
+        Cells outside of the raster layer never contain data, so the parts of the
+        geometry outside of the raster layer do not contribute to the result. The
+        extent is buffered with one cell, so the cells along the edge of the raster
+        layer are still fully covered by the clipped geometry.
+
+        The result is always a valid (multi)polygon: invalid geometries are repaired
+        and any points or lines resulting from the clip are dropped.
+
+        Parameters
+        ----------
+        geometry : QGisCore.QgsGeometry
+            Geometry to clip.
+
+        Returns
+        -------
+        QGisCore.QgsGeometry
+            The part of the geometry overlapping the (buffered) extent of the raster
+            layer. Empty if there is no polygonal overlap.
+        """
+        clipRect = self.rasterLayer.extent().buffered(self._buffer)
+        if not clipRect.contains(geometry.boundingBox()):
+            geometry = geometry.intersection(QGisCore.QgsGeometry.fromRect(clipRect))
+
+        if not geometry.isGeosValid():
+            geometry = geometry.makeValid()
+
+        # Generic geometry collections have no polygon geometry type, even if they only contain polygons.
+        if geometry.type() == QGisCore.QgsWkbTypes.PolygonGeometry:
+            return geometry
+
+        return QGisCore.QgsGeometry.collectGeometry(
+            [part for part in geometry.asGeometryCollection()
+             if part.type() == QGisCore.QgsWkbTypes.PolygonGeometry])
+
     def _alignRectangleToGrid(self, rect):
         """Aligns the given rectangle to the grid of the raster layer.
 
@@ -71,24 +138,203 @@ class RasterBlockWrapperTask(QGisCore.QgsTask):
         QGisCore.QgsRectangle
             New rectangle, aligned to the grid of the raster layer.
         """
+        # Work with integer cell indices relative to the origin of the raster, so all
+        # coordinates are calculated from the origin without accumulating rounding errors.
+        rasterExtent = self.rasterLayer.extent()
+        col0 = round((rect.xMinimum()-rasterExtent.xMinimum()) / self.pixelSizeX)
+        row0 = round((rect.yMinimum()-rasterExtent.yMinimum()) / self.pixelSizeY)
+        col1 = col0 + int(rect.width()/self.pixelSizeX)
+        row1 = row0 + int(rect.height()/self.pixelSizeY)
+
+        return QGisCore.QgsRectangle(
+            rasterExtent.xMinimum() + col0*self.pixelSizeX, rasterExtent.yMinimum() + row0*self.pixelSizeY,
+            rasterExtent.xMinimum() + col1*self.pixelSizeX, rasterExtent.yMinimum() + row1*self.pixelSizeY)
+
+    def _cellEdges(self):
+        """Get the coordinates of the edges of the columns and rows of the raster block.
+        The coordinates are calculated from the origin of the raster layer and the
+        integer cell indices, to match the grid of the raster layer exactly.
+
+        Returns
+        -------
+        tuple of numpy.ndarray
+            The x coordinates of the column edges (blockWidth + 1 values, from left
+            to right) and the y coordinates of the row edges (blockHeight + 1
+            values, from top to bottom).
+        """
         rasterExtent = self.rasterLayer.extent()
-        newRect = QGisCore.QgsRectangle()
-        newRect.setXMinimum(rasterExtent.xMinimum() + (round(
-            (rect.xMinimum()-rasterExtent.xMinimum()) / self.pixelSizeX) *
-            self.pixelSizeX))
-        newRect.setYMinimum(rasterExtent.yMinimum() + (round(
-            (rect.yMinimum()-rasterExtent.yMinimum()) / self.pixelSizeY) *
-            self.pixelSizeY))
-        newRect.setXMaximum(newRect.xMinimum() + (int(
-            rect.width()/self.pixelSizeX)*self.pixelSizeX))
-        newRect.setYMaximum(newRect.yMinimum() + (int(
-            rect.height()/self.pixelSizeY)*self.pixelSizeY))
-        return newRect
+        col0 = round((self.blockBbox.xMinimum()-rasterExtent.xMinimum()) / self.pixelSizeX)
+        row0 = round((rasterExtent.yMaximum()-self.blockBbox.yMaximum()) / self.pixelSizeY)
+
+        xs = rasterExtent.xMinimum() + (col0 + np.arange(self.blockWidth + 1)) * self.pixelSizeX
+        ys = rasterExtent.yMaximum() - (row0 + np.arange(self.blockHeight + 1)) * self.pixelSizeY
+        return xs, ys
+
+    def _readBlock(self, blockCache):
+        """Read the raster block of the block bounding box into `block` and `blockArray`.
+
+        Reuse the block of the given cache if it covers the block bounding box, read
+        it from the data provider of the raster layer otherwise. Sets `blockCache`
+        to the cache to pass on to a next task.
+
+        Blocks larger than `_MAX_BLOCK_CELLS` are not read here, but tile by tile
+        while running the task (see `_blockTiles`), to limit the memory usage.
+
+        Parameters
+        ----------
+        blockCache : tuple or None
+            Cache of a previous task, as a tuple of the band, the block bounding box,
+            the raster block and its array.
+        """
+        if blockCache is not None:
+            band, bbox, block, array = blockCache
+            if band == self.band and bbox.contains(self.blockBbox):
+                r = int(round((bbox.yMaximum() - self.blockBbox.yMaximum()) / self.pixelSizeY))
+                c = int(round((self.blockBbox.xMinimum() - bbox.xMinimum()) / self.pixelSizeX))
+                if r + self.blockHeight <= array.shape[0] and c + self.blockWidth <= array.shape[1]:
+                    self.block = block
+                    self.blockArray = array[r:r + self.blockHeight, c:c + self.blockWidth]
+                    self.blockCache = blockCache
+                    return
+
+        if self.blockWidth * self.blockHeight > _MAX_BLOCK_CELLS:
+            # Raster data providers are not thread safe, use a clone to read the tiles from the task.
+            self.provider = self.rasterLayer.dataProvider().clone()
+            self.block = self.blockArray = self.blockCache = None
+            return
+
+        self.block = self.rasterLayer.dataProvider().block(self.band,
+                                                           self.blockBbox,
+                                                           self.blockWidth,
+                                                           self.blockHeight)
+        self.blockArray = self._blockToArray(self.block)
+        self.blockCache = (self.band, self.blockBbox, self.block, self.blockArray)
+
+    def _blockToArray(self, block):
+        """Convert the given raster block to a two dimensional NumPy array.
+
+        Parameters
+        ----------
+        block : QGisCore.QgsRasterBlock
+            Raster block to convert.
+
+        Returns
+        -------
+        numpy.ndarray
+            Array with the shape of the block containing its cell values.
+        """
+        dtype = _NUMPY_DTYPES.get(block.dataType())
+        if dtype is not None:
+            # The QByteArray wraps the memory of the block: this is a read-only view, not a copy.
+            # The array keeps a reference to it, but the block itself must be kept alive as well.
+            return np.frombuffer(block.data(), dtype=dtype).reshape(
+                block.height(), block.width())
+
+        # Fall back to reading the values one by one for data types without a NumPy equivalent.
+        return np.array([[block.value(r, c) for c in range(block.width())]
+                         for r in range(block.height())], dtype=np.float64)
+
+    def _blockTiles(self):
+        """Iterate over the cell values of the raster block, in tiles of consecutive rows.
+
+        Yields
+        ------
+        tuple
+            The slice of the rows of the tile and the array of its cell values. If
+            the raster block was read completely, this is a single tile
+            containing the whole block.
+        """
+        if self.blockArray is not None:
+            yield slice(0, self.blockHeight), self.blockArray
+            return
+
+        tileHeight = max(1, _MAX_BLOCK_CELLS // self.blockWidth)
+        for r0 in range(0, self.blockHeight, tileHeight):
+            r1 = min(self.blockHeight, r0 + tileHeight)
+            tileBbox = QGisCore.QgsRectangle(self.blockBbox.xMinimum(),
+                                             self.blockBbox.yMaximum() - r1*self.pixelSizeY,
+                                             self.blockBbox.xMaximum(),
+                                             self.blockBbox.yMaximum() - r0*self.pixelSizeY)
+            block = self.provider.block(self.band, tileBbox, self.blockWidth, r1 - r0)
+            yield slice(r0, r1), self._blockToArray(block)
+
+    def _indexParts(self):
+        """Build a spatial index of the parts of the geometry, if it consists of many parts.
+
+        Sets `geometryParts` to the list of parts and `partIndex` to the QgsSpatialIndex
+        of their bounding boxes, or both to `None` for geometries with fewer parts.
+        """
+        self.geometryParts = self.partIndex = None
+
+        if self.geometry.isMultipart() and self.geometry.constGet().numGeometries() > _PART_INDEX_THRESHOLD:
+            self.geometryParts = self.geometry.asGeometryCollection()
+            self.partIndex = QGisCore.QgsSpatialIndex()
+            for i, part in enumerate(self.geometryParts):
+                feature = QGisCore.QgsFeature(i)
+                feature.setGeometry(part)
+                self.partIndex.addFeature(feature)
+
+    def _overlapArea(self, cellGeom):
+        """Calculate the area of the overlap between the geometry and a raster cell.
+
+        Parameters
+        ----------
+        cellGeom : QGisCore.QgsGeometry
+            The geometry of the raster cell.
+
+        Returns
+        -------
+        float
+            Area of the part of the raster cell that falls inside the geometry.
+        """
+        if self.partIndex is None:
+            return self.geometry.intersection(cellGeom).area()
+
+        return sum(self.geometryParts[i].intersection(cellGeom).area()
+                   for i in self.partIndex.intersects(cellGeom.boundingBox()))
+
+    def _geometryEngine(self):
+        """Get the prepared geometry engine of the geometry, creating it on first use.
+
+        Returns
+        -------
+        QGisCore.QgsGeometryEngine
+            Prepared geometry engine of the geometry.
+        """
+        if self._engine is None:
+            self._engine = QGisCore.QgsGeometry.createGeometryEngine(self.geometry.constGet())
+            self._engine.prepareGeometry()
+        return self._engine
+
+    def _hasDataMask(self, array):
+        """Get the mask of the cells of the given array that contain data.
+
+        Parameters
+        ----------
+        array : numpy.ndarray
+            Cell values of (a tile of) the raster block.
+
+        Returns
+        -------
+        numpy.ndarray
+            Boolean array with the shape of the given array, `False` for the
+            cells containing the nodata value of the band.
+        """
+        if self.noData is None:
+            return np.ones(array.shape, dtype=bool)
+
+        if math.isnan(self.noData):
+            return ~np.isnan(array)
+
+        return array != self.noData
 
     def _rasterCellMatchesGeometry(self, rect):
         """Check whether a given raster cell belongs to the geometry.
         In casu: a raster cell belongs to the geometry if at least 50 percent
         of the area of the raster cell falls inside the geometry.
+        Cells completely inside or outside the geometry are classified using the
+        prepared geometry, only cells on the border of the geometry need the
+        (more expensive) calculation of the intersection area.
         Parameters
         ----------
         rect : QGisCore.QgsRectangle
@@ -99,115 +345,338 @@ class RasterBlockWrapperTask(QGisCore.QgsTask):
             `True` if the raster cell belongs to the geometry, `False`
             otherwise.
         """
-        # 50% overlap
-        return self.geometry.intersection(
-            QGisCore.QgsGeometry.fromRect(rect)).area() >= (self.pixelArea*0.5)
+        cellGeom = QGisCore.QgsGeometry.fromRect(rect)
+        cellAbstractGeom = cellGeom.constGet()
+        engine = self._geometryEngine()
 
-    def run(self):
-        """Calculate the new, aligned, geometry.
-        Loop over all raster cells within the bounding box of the geometry and
-        check for each of them if they should be part of the new geometry.
-        Build a new QgsGeometry from the matching cells.
-        Also builds a dictionary of statistics for the new QgsGeometry: listing
-        the count, sum and average (mean) values of the raster cells it
-        contains.
+        if engine.contains(cellAbstractGeom):
+            return True
+
+        if not engine.intersects(cellAbstractGeom):
+            return False
+
+        return self._overlapArea(cellGeom) >= self.minOverlapArea
+
+    def _geometryWindow(self):
+        """Get the window of cells of the raster block covered by the bounding box of the geometry.
+
+        Returns
+        -------
+        tuple of slice
+            Row and column slices of the cells of the block that overlap the
+            bounding box of the geometry. Cells outside of it can never belong
+            to the geometry.
         """
-        valSum = 0
-        valCnt = 0
+        bbox = self.geometry.boundingBox()
+        r0 = max(0, math.floor((self.blockBbox.yMaximum() - bbox.yMaximum()) / self.pixelSizeY))
+        r1 = min(self.blockHeight, math.ceil((self.blockBbox.yMaximum() - bbox.yMinimum()) / self.pixelSizeY))
+        c0 = max(0, math.floor((bbox.xMinimum() - self.blockBbox.xMinimum()) / self.pixelSizeX))
+        c1 = min(self.blockWidth, math.ceil((bbox.xMaximum() - self.blockBbox.xMinimum()) / self.pixelSizeX))
+        return slice(r0, r1), slice(c0, c1)
 
-        if self.block is None:
-            self.completed.emit((self.newGeometry, self.stats))
-            return True
+    def _rasterWindow(self):
+        """Get the window of cells of the raster block within the extent of the raster layer.
+
+        Returns
+        -------
+        tuple of slice
+            Row and column slices of the cells of the block that are part of the
+            raster layer. Cells outside of it never contain data.
+        """
+        # The block is aligned to the grid of the raster layer, so the borders of the window are whole cells.
+        extent = self.rasterLayer.extent()
+        r0 = max(0, round((self.blockBbox.yMaximum() - extent.yMaximum()) / self.pixelSizeY))
+        r1 = min(self.blockHeight, round((self.blockBbox.yMaximum() - extent.yMinimum()) / self.pixelSizeY))
+        c0 = max(0, round((extent.xMinimum() - self.blockBbox.xMinimum()) / self.pixelSizeX))
+        c1 = min(self.blockWidth, round((extent.xMaximum() - self.blockBbox.xMinimum()) / self.pixelSizeX))
+        return slice(r0, r1), slice(c0, c1)
+
+    def _createBlockRaster(self):
+        """Create an in-memory, single band, GDAL raster with the grid of the raster block.
+
+        Returns
+        -------
+        gdal.Dataset
+            Empty byte raster of blockWidth by blockHeight cells covering the block bounding box.
+        """
+        raster = gdal.GetDriverByName('MEM').Create(
+            '', self.blockWidth, self.blockHeight, 1, gdal.GDT_Byte)
+        raster.SetGeoTransform((self.blockBbox.xMinimum(), self.pixelSizeX, 0,
+                                self.blockBbox.yMaximum(), 0, -self.pixelSizeY))
+        return raster
+
+    def _rasterizeGeometry(self, geometry, allTouched=False):
+        """Rasterize the given geometry to the grid of the raster block.
+
+        Parameters
+        ----------
+        geometry : QGisCore.QgsGeometry
+            Geometry to rasterize.
+        allTouched : boolean, optional, default `False`
+            Whether to include all cells touched by the geometry, instead of
+            only the cells whose center falls inside the geometry.
+
+        Returns
+        -------
+        numpy.ndarray
+            Boolean array of shape (blockHeight, blockWidth), `True` for the
+            cells covered by the geometry.
+        """
+        raster = self._createBlockRaster()
+
+        source = ogr.GetDriverByName('Memory').CreateDataSource('')
+        layer = source.CreateLayer('geometry', geom_type=ogr.wkbUnknown)
+        feature = ogr.Feature(layer.GetLayerDefn())
+        feature.SetGeometry(ogr.CreateGeometryFromWkb(bytes(geometry.asWkb())))
+        layer.CreateFeature(feature)
+
+        gdal.RasterizeLayer(raster, [1], layer, burn_values=[1],
+                            options=['ALL_TOUCHED={}'.format('TRUE' if allTouched else 'FALSE')])
+        return raster.GetRasterBand(1).ReadAsArray().astype(bool)
+
+    def _polygonizeMask(self, mask):
+        """Create a geometry covering all the cells of the given mask.
+
+        Parameters
+        ----------
+        mask : numpy.ndarray
+            Boolean array of shape (blockHeight, blockWidth), `True` for the
+            cells to include in the geometry.
 
-        self.progressDone = 0
-        self.progressTodo = self.blockHeight * self.blockWidth * 2
-        self.lock = Lock()
+        Returns
+        -------
+        QGisCore.QgsGeometry or None
+            Multipolygon geometry covering the cells of the mask, aligned to
+            the grid of the raster block. `None` if the mask is empty.
+        """
+        if not mask.any():
+            return None
+
+        raster = self._createBlockRaster()
+        band = raster.GetRasterBand(1)
+        band.WriteArray(mask.astype(np.uint8))
+
+        source = ogr.GetDriverByName('Memory').CreateDataSource('')
+        layer = source.CreateLayer('mask', geom_type=ogr.wkbPolygon)
+        layer.CreateField(ogr.FieldDefn('value', ogr.OFTInteger))
+
+        # Use the mask itself as the mask band, so only the cells of the mask are polygonized.
+        gdal.Polygonize(band, band, layer, 0)
 
-        noData = None
-        if self.rasterLayer.dataProvider().sourceHasNoDataValue(self.band):
-            noData = self.rasterLayer.dataProvider().sourceNoDataValue(self.band)
+        multiPolygon = ogr.Geometry(ogr.wkbMultiPolygon)
+        for feature in layer:
+            multiPolygon.AddGeometry(feature.GetGeometryRef())
 
-        def processPixel(r, c):
-            cellRect = QGisCore.QgsRectangle()
-            cellRect.setXMinimum(self.blockBbox.xMinimum() +
-                                 (c*self.pixelSizeX))
-            cellRect.setYMinimum(self.blockBbox.yMaximum() -
-                                 (r*self.pixelSizeY)-self.pixelSizeY)
-            cellRect.setXMaximum(self.blockBbox.xMinimum() +
-                                 (c*self.pixelSizeX)+self.pixelSizeX)
-            cellRect.setYMaximum(self.blockBbox.yMaximum() -
-                                 (r*self.pixelSizeY))
-            if self._rasterCellMatchesGeometry(cellRect):
-                value = self.block.value(r, c)
+        geometry = QGisCore.QgsGeometry()
+        geometry.fromWkb(bytes(multiPolygon.ExportToWkb()))
+        return geometry
 
-                if noData and value == noData:
-                    return None, None
+    def _growMask(self, mask):
+        """Grow the given mask with one cell in every direction, including diagonally.
+
+        Parameters
+        ----------
+        mask : numpy.ndarray
+            Boolean array to grow.
+
+        Returns
+        -------
+        numpy.ndarray
+            New boolean array with the same shape as the given mask.
+        """
+        padded = np.pad(mask, 1)
+        grown = np.zeros(mask.shape, dtype=bool)
+        for dr in range(3):
+            for dc in range(3):
+                grown |= padded[dr:dr + mask.shape[0], dc:dc + mask.shape[1]]
+        return grown
 
-                return QGisCore.QgsGeometry.fromRect(cellRect), value
+    def _axisAlignedRectangle(self):
+        """Get the rectangle the geometry consists of, if it is an axis aligned rectangle.
 
-            return None, None
+        Returns
+        -------
+        QGisCore.QgsRectangle or None
+            The bounding box of the geometry if the geometry covers it completely,
+            `None` otherwise.
+        """
+        if self.geometry.constGet().partCount() != 1 or \
+                self.geometry.type() != QGisCore.QgsWkbTypes.PolygonGeometry:
+            return None
 
-        def aggregateGeometry(aggregate, item):
-            if aggregate is None:
-                return item
+        # A polygon with the same area as its bounding box is the bounding box.
+        bbox = self.geometry.boundingBox()
+        if abs(self.geometry.area() - bbox.area()) > bbox.area() * 1e-9:
+            return None
 
-            if item is not None:
-                return aggregate.combine(item)
+        return bbox
 
-            return aggregate
+    def _rectangleMask(self, rect):
+        """Get the mask of the cells of the raster block matching the given rectangle.
+        The overlap of each cell with an axis aligned rectangle is calculated
+        directly from the coordinates, without the need for any geometry
+        operations.
 
-        def progressTracker():
-            self.progressDone += 1
-            self.setProgress((self.progressDone / self.progressTodo) * 100)
+        Parameters
+        ----------
+        rect : QGisCore.QgsRectangle
+            The axis aligned rectangle.
 
-        def cancelFunction():
-            return self.shouldCancel
+        Returns
+        -------
+        numpy.ndarray
+            Boolean array of shape (blockHeight, blockWidth), `True` for the
+            cells of which at least 50 percent falls inside the rectangle.
+        """
+        xs, ys = self._cellEdges()
 
-        processPixelPool = WorkerThreadPool(progress_function=progressTracker)
-        aggregateGeomPool = WorkerThreadPool(
-            progress_function=progressTracker,
-            cancel_function=cancelFunction,
-            aggregation_function=aggregateGeometry)
+        overlapX = np.clip(np.minimum(xs[1:], rect.xMaximum()) - np.maximum(xs[:-1], rect.xMinimum()), 0, None)
+        overlapY = np.clip(np.minimum(ys[:-1], rect.yMaximum()) - np.maximum(ys[1:], rect.yMinimum()), 0, None)
 
-        for r in range(self.blockHeight):
-            for c in range(self.blockWidth):
+        return np.outer(overlapY, overlapX) >= self.minOverlapArea
+
+    def _geometryMask(self, hasData):
+        """Get the mask of the cells of the raster block matching the geometry.
+        Rasterize the geometry onto the raster block: cells away from the
+        border of the geometry are either completely inside or completely
+        outside of it and are classified directly. Only the cells along the
+        border are checked one by one if they should be part of the new
+        geometry.
+
+        Parameters
+        ----------
+        hasData : numpy.ndarray
+            Boolean array of shape (blockHeight, blockWidth), `True` for the
+            cells of the block containing data.
+
+        Returns
+        -------
+        numpy.ndarray or None
+            Boolean array of shape (blockHeight, blockWidth), `True` for the
+            cells containing data that belong to the geometry. `None` if the
+            task was canceled.
+        """
+        # The border cells are grown with one cell to guard against cells missed by the rasterization.
+        inside = self._rasterizeGeometry(self.geometry)
+        border = self._growMask(self._rasterizeGeometry(
+            QGisCore.QgsGeometry(self.geometry.constGet().boundary()), allTouched=True))
+
+        mask = inside & ~border & hasData
+
+        # Only the border cells within the bounding box of the geometry can match.
+        candidates = np.zeros((self.blockHeight, self.blockWidth), dtype=bool)
+        candidates[self._geometryWindow()] = True
+        borderCells = np.argwhere(border & hasData & candidates)
+
+        # Edge coordinates of the columns and rows of the block.
+        xs, ys = (edges.tolist() for edges in self._cellEdges())
+
+        # Reuse a single rectangle for all the cells, and avoid attribute lookups in the loop.
+        cellRect = QGisCore.QgsRectangle()
+        setRect = cellRect.set
+        cellMatchesGeometry = self._rasterCellMatchesGeometry
+
+        # Check for cancellation about every percent, only report progress when the percentage changes.
+        cellCount = len(borderCells)
+        progressStep = max(1, cellCount // 100)
+        lastProgress = -1
+
+        for i, (r, c) in enumerate(borderCells.tolist()):
+            if i % progressStep == 0:
                 if self.shouldCancel:
-                    break
+                    return None
+                progress = (i * 100) // cellCount
+                if progress != lastProgress:
+                    lastProgress = progress
+                    self.setProgress(progress)
 
-                processPixelPool.execute(processPixel, (r, c))
+            setRect(xs[c], ys[r + 1], xs[c + 1], ys[r])
+            if cellMatchesGeometry(cellRect):
+                mask[r, c] = True
 
-            if self.shouldCancel:
-                break
+        return mask
 
-        for res in processPixelPool.join():
-            if self.shouldCancel:
-                self.failed.emit()
-                return False
+    def run(self):
+        """Calculate the new, aligned, geometry and emit the result.
+        Emits `completed` with the new geometry and its statistics, or `failed`
+        if the task was canceled or the calculation raised an error.
+        """
+        if self.blockBbox is None:
+            self.completed.emit((self.newGeometry, self.stats))
+            return True
 
-            rect, value = res.get_result()
+        try:
+            calculated = self._calculate()
+        except Exception:
+            # Never leave the drawn feature waiting for a result, let QGIS report the error itself.
+            self.failed.emit()
+            raise
 
-            if rect is not None and value is not None:
-                valSum += value
-                valCnt += 1
+        if not calculated:
+            self.failed.emit()
+            return False
 
-                aggregateGeomPool.execute(lambda x: x, (rect,))
-            else:
-                progressTracker()
+        self.completed.emit((self.newGeometry, self.stats))
+        return True
+
+    def _calculate(self):
+        """Calculate the new, aligned, geometry.
+        Determine which raster cells within the bounding box of the geometry
+        should be part of the new geometry. Axis aligned rectangles are handled
+        directly, other geometries are rasterized onto the raster block.
+        Build a new QgsGeometry by polygonizing the matching cells.
+        Also builds a dictionary of statistics for the new QgsGeometry: listing
+        the count, sum and average (mean) values of the raster cells it
+        contains.
 
-        for res in aggregateGeomPool.join():
+        Returns
+        -------
+        boolean
+            `True` if `newGeometry` and `stats` have been calculated, `False`
+            if the task was canceled.
+        """
+        if self.blockArray is not None:
+            hasData = self._hasDataMask(self.blockArray)
+        else:
+            # Nodata cells of a tiled block are only known when reading the tiles below.
+            hasData = np.ones((self.blockHeight, self.blockWidth), dtype=bool)
+
+        # The block can extend beyond the raster layer, whose cells have no data even without a nodata value.
+        inRaster = np.zeros((self.blockHeight, self.blockWidth), dtype=bool)
+        inRaster[self._rasterWindow()] = True
+        hasData &= inRaster
+
+        rectangle = self._axisAlignedRectangle()
+        if rectangle is not None:
+            mask = self._rectangleMask(rectangle) & hasData
+        else:
+            mask = self._geometryMask(hasData)
+
+        if mask is None or self.shouldCancel:
+            return False
+
+        valSum = 0.0
+        valCnt = 0
+
+        for rows, array in self._blockTiles():
             if self.shouldCancel:
-                self.failed.emit()
                 return False
 
-            geom = res.get_result()
-            self.newGeometry = aggregateGeometry(self.newGeometry, geom)
+            tileMask = mask[rows]
+            if self.blockArray is None:
+                tileMask &= self._hasDataMask(array)
+
+            # Accumulate in double precision, regardless of the data type of the raster.
+            valSum += float(np.sum(array, where=tileMask, dtype=np.float64))
+            valCnt += int(np.count_nonzero(tileMask))
+
+        self.newGeometry = self._polygonizeMask(mask)
 
         if valCnt > 0:
             self.stats['sum'] = valSum
             self.stats['count'] = valCnt
             self.stats['mean'] = valSum/float(valCnt)
 
-        self.completed.emit((self.newGeometry, self.stats))
         return True
 
     def cancel(self):
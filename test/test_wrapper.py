@@ -0,0 +1,218 @@
+# coding=utf-8
+"""RasterBlockWrapperTask test.
+
+Compare the cells selected by the task against a brute force check of the
+overlap of every raster cell with the geometry.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+     it under the terms of the GNU General Public License as published by
+     the Free Software Foundation; either version 2 of the License, or
+     (at your option) any later version.
+
+"""
+
+__author__ = 'roel@huybrechts.re'
+__date__ = '2026-10-15'
+__copyright__ = 'Copyright 2022, Roel Huybrechts'
+
+import math
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+from osgeo import gdal, osr
+from qgis.core import QgsGeometry, QgsPointXY, QgsRasterLayer, QgsRectangle
+
+from pixel_measure import wrapper
+from pixel_measure.wrapper import RasterBlockWrapperTask
+
+from .utilities import get_qgis_app
+QGIS_APP = get_qgis_app()
+
+# Grid of the test rasters: top left corner, cell size and number of cells.
+X0 = 1000.0
+Y0 = 2000.0
+PIXEL_SIZE = 1.0
+WIDTH = 40
+HEIGHT = 40
+
+
+class Main:
+    """Stub of the PixelCalculator main class."""
+
+    def tr(self, message):
+        return message
+
+
+def ring(cx, cy, half, angle):
+    """Closed ring of a square with the given center and half side, rotated by angle degrees."""
+    cos = math.cos(math.radians(angle))
+    sin = math.sin(math.radians(angle))
+    points = [QgsPointXY(cx + dx*cos - dy*sin, cy + dx*sin + dy*cos)
+              for dx, dy in ((-half, -half), (half, -half), (half, half), (-half, half))]
+    return points + [points[0]]
+
+
+def rotated_square():
+    return QgsGeometry.fromPolygonXY([ring(1019.13, 1979.87, 11.7, 27)])
+
+
+def polygon_with_hole():
+    return QgsGeometry.fromPolygonXY([ring(1020.31, 1980.17, 14.2, 10), ring(1019.77, 1979.59, 5.3, 41)])
+
+
+def multipart_polygon():
+    return QgsGeometry.fromMultiPolygonXY([[ring(1005.37 + 11.1*i, 1994.41 - 9.7*j, 2.9, 13 + 7*i + 5*j)]
+                                           for i in range(3) for j in range(4)])
+
+
+def axis_aligned_rectangle():
+    # The edges cover 70%, 60%, 30% and 20% of the cells along them, far away from the 50% threshold.
+    return QgsGeometry.fromRect(QgsRectangle(1003.3, 1961.7, 1031.6, 1992.2))
+
+
+def partially_outside():
+    return QgsGeometry.fromPolygonXY([ring(1002.2, 1997.9, 6.3, 17)])
+
+
+class RasterBlockWrapperTaskTest(unittest.TestCase):
+    """Test the cells selected by the RasterBlockWrapperTask."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp()
+        cls.rasterCount = 0
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.directory, ignore_errors=True)
+
+    def createRaster(self, values, noData=None):
+        """Write the values to a GeoTIFF on the test grid and open it as a raster layer."""
+        RasterBlockWrapperTaskTest.rasterCount += 1
+        path = os.path.join(self.directory, 'raster_{}.tif'.format(self.rasterCount))
+
+        dataset = gdal.GetDriverByName('GTiff').Create(path, WIDTH, HEIGHT, 1, gdal.GDT_Float32)
+        dataset.SetGeoTransform((X0, PIXEL_SIZE, 0, Y0, 0, -PIXEL_SIZE))
+        srs = osr.SpatialReference()
+        srs.ImportFromEPSG(31370)
+        dataset.SetProjection(srs.ExportToWkt())
+        band = dataset.GetRasterBand(1)
+        if noData is not None:
+            band.SetNoDataValue(noData)
+        band.WriteArray(values)
+        dataset = None
+
+        layer = QgsRasterLayer(path, 'raster')
+        self.assertTrue(layer.isValid())
+        return layer
+
+    def values(self):
+        return (np.arange(WIDTH * HEIGHT, dtype=np.float32).reshape(HEIGHT, WIDTH) % 17) + 1
+
+    def expectedCells(self, values, geometry, noData=None):
+        """Brute force: a cell belongs to the geometry if at least half of it is covered by the geometry."""
+        expected = np.zeros((HEIGHT, WIDTH), dtype=bool)
+        for r in range(HEIGHT):
+            for c in range(WIDTH):
+                cell = QgsGeometry.fromRect(QgsRectangle(X0 + c*PIXEL_SIZE, Y0 - (r + 1)*PIXEL_SIZE,
+                                                         X0 + (c + 1)*PIXEL_SIZE, Y0 - r*PIXEL_SIZE))
+                expected[r, c] = geometry.intersection(cell).area() >= PIXEL_SIZE*PIXEL_SIZE/2
+
+        if noData is None:
+            return expected
+        if math.isnan(noData):
+            return expected & ~np.isnan(values)
+        return expected & (values != noData)
+
+    def runTask(self, layer, geometry, blockCache=None):
+        task = RasterBlockWrapperTask(Main(), layer, 1, geometry, blockCache=blockCache)
+
+        results = []
+        task.completed.connect(results.append)
+        task.failed.connect(lambda: results.append(None))
+
+        self.assertTrue(task.run())
+        self.assertEqual(len(results), 1)
+        self.assertIsNotNone(results[0])
+        return task, results[0]
+
+    def assertMatchesBruteForce(self, layer, values, geometry, noData=None, blockCache=None):
+        task, (newGeometry, stats) = self.runTask(layer, geometry, blockCache)
+        expected = self.expectedCells(values, geometry, noData)
+        count = int(np.count_nonzero(expected))
+        self.assertGreater(count, 0)
+
+        self.assertEqual(stats['count'], count)
+        self.assertAlmostEqual(stats['sum'], float(values[expected].astype(np.float64).sum()), places=6)
+        self.assertAlmostEqual(newGeometry.area(), count * PIXEL_SIZE * PIXEL_SIZE, places=6)
+
+        for r in range(HEIGHT):
+            for c in range(WIDTH):
+                center = QgsGeometry.fromPointXY(QgsPointXY(X0 + (c + 0.5)*PIXEL_SIZE, Y0 - (r + 0.5)*PIXEL_SIZE))
+                self.assertEqual(newGeometry.contains(center), bool(expected[r, c]), (r, c))
+
+        return task
+
+    def test_rotated_polygon(self):
+        values = self.values()
+        task = self.assertMatchesBruteForce(self.createRaster(values), values, rotated_square())
+        self.assertIsNone(task._axisAlignedRectangle())
+
+    def test_polygon_with_hole(self):
+        values = self.values()
+        self.assertMatchesBruteForce(self.createRaster(values), values, polygon_with_hole())
+
+    def test_multipart_polygon(self):
+        values = self.values()
+        task = self.assertMatchesBruteForce(self.createRaster(values), values, multipart_polygon())
+        self.assertIsNotNone(task.partIndex)
+
+    def test_axis_aligned_rectangle(self):
+        values = self.values()
+        task = self.assertMatchesBruteForce(self.createRaster(values), values, axis_aligned_rectangle())
+        self.assertIsNotNone(task._axisAlignedRectangle())
+
+    def test_partially_outside(self):
+        values = self.values()
+        self.assertMatchesBruteForce(self.createRaster(values), values, partially_outside())
+
+    def test_nodata_zero(self):
+        values = self.values()
+        values[::3, ::2] = 0
+        layer = self.createRaster(values, noData=0)
+        for geometry in (rotated_square(), axis_aligned_rectangle()):
+            with self.subTest(geometry=geometry.asWkt()):
+                self.assertMatchesBruteForce(layer, values, geometry, noData=0)
+
+    def test_nodata_nan(self):
+        values = self.values()
+        values[1::4, ::3] = np.nan
+        layer = self.createRaster(values, noData=np.nan)
+        for geometry in (rotated_square(), axis_aligned_rectangle()):
+            with self.subTest(geometry=geometry.asWkt()):
+                self.assertMatchesBruteForce(layer, values, geometry, noData=np.nan)
+
+    def test_tiled_block(self):
+        values = self.values()
+        values[1::4, ::3] = np.nan
+        layer = self.createRaster(values, noData=np.nan)
+        with mock.patch.object(wrapper, '_MAX_BLOCK_CELLS', 50):
+            task = self.assertMatchesBruteForce(layer, values, polygon_with_hole(), noData=np.nan)
+        self.assertIsNone(task.blockArray)
+
+    def test_block_cache(self):
+        values = self.values()
+        layer = self.createRaster(values)
+        first, _ = self.runTask(layer, QgsGeometry.fromRect(QgsRectangle(1001.2, 1961.2, 1038.8, 1998.8)))
+        task = self.assertMatchesBruteForce(layer, values, rotated_square(), blockCache=first.blockCache)
+        self.assertIs(task.blockCache, first.blockCache)
+
+
+if __name__ == "__main__":
+    suite = unittest.makeSuite(RasterBlockWrapperTaskTest)
+    runner = unittest.TextTestRunner(verbosity=2)
+    runner.run(suite)